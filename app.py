@@ -1,33 +1,165 @@
 import streamlit as st
-import requests, uuid, json, os
+import gc, requests, uuid, os
+import orjson
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from sse_stream import sse_tokens
+
 # ---------------- CONFIG ----------------
 st.set_page_config("RAG Chatbot", "🤖", layout="wide")
 API_URL = "http://localhost:8000"
-SESSIONS_FILE = "chat_sessions.json"
+SESSIONS_DIR = "sessions"  # one append-only <id>.jsonl message log per chat
+INDEX_FILE = os.path.join(SESSIONS_DIR, "index.json")  # id → title/updated/doc_uploaded
+LEGACY_SESSIONS_FILE = "chat_sessions.json"
+HISTORY_PAGE = 50  # messages rendered per "load older" step
+
+@st.cache_resource
+def get_http():
+    # One keep-alive connection pool shared by every rerun
+    http = requests.Session()
+    http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return http
+
+HTTP = get_http()
+
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+EXECUTOR = get_executor()
 
 # ---------------- HELPERS ----------------
 def now():
     return datetime.now().isoformat()
 
+def session_log(sid):
+    return os.path.join(SESSIONS_DIR, f"{sid}.jsonl")
+
+def read_messages(sid):
+    if not os.path.exists(session_log(sid)):
+        return []
+    with open(session_log(sid), "rb") as f:
+        return [orjson.loads(line) for line in f if line.strip()]
+
 def load_sessions():
-    if os.path.exists(SESSIONS_FILE):
-        try:
-            return json.load(open(SESSIONS_FILE))
-        except:
-            pass
-    return {}
+    if not os.path.exists(INDEX_FILE):
+        return migrate_legacy()
+    try:
+        index = orjson.loads(open(INDEX_FILE, "rb").read())
+    except:
+        return {}
+    return {
+        sid: {**meta, "updated": log_updated(sid, meta.get("updated")), "messages": read_messages(sid)}
+        for sid, meta in index.items()
+    }
+
+def log_updated(sid, default):
+    # A chat's last activity is its log's last append, so the index needn't
+    # be rewritten on every turn
+    if not os.path.exists(session_log(sid)):
+        return default
+    return datetime.fromtimestamp(os.path.getmtime(session_log(sid))).isoformat()
+
+def migrate_legacy():
+    # Split the old single-file store into the per-session layout once
+    try:
+        sessions = orjson.loads(open(LEGACY_SESSIONS_FILE, "rb").read())
+    except:
+        return {}
+    for sid, data in sessions.items():
+        append_messages(sid, *data.get("messages", []))
+        if data.get("updated"):
+            # Keep the old ordering; it is read back from the log's mtime
+            ts = datetime.fromisoformat(data["updated"]).timestamp()
+            os.utime(session_log(sid), (ts, ts))
+    save_index(sessions)
+    return sessions
 
-def save_sessions():
-    json.dump(st.session_state.sessions, open(SESSIONS_FILE, "w"), indent=2)
+def save_index(sessions):
+    # Small metadata file; rewritten on create/delete/upload, never per turn
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    index = {sid: {k: v for k, v in s.items() if k != "messages"} for sid, s in sessions.items()}
+    open(INDEX_FILE, "wb").write(orjson.dumps(index))
+
+def append_messages(sid, *msgs):
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    with open(session_log(sid), "ab") as f:
+        for msg in msgs:
+            f.write(orjson.dumps(msg, option=orjson.OPT_APPEND_NEWLINE))
+
+def delete_session(sid):
+    # Also drop the backend session so its document index can be removed
+    try:
+        HTTP.delete(f"{API_URL}/session/{sid}", timeout=10)
+    except requests.RequestException:
+        pass  # backend down; the chat is still removed locally
+    del st.session_state.sessions[sid]
+    if os.path.exists(session_log(sid)):
+        os.remove(session_log(sid))
+    save_index(st.session_state.sessions)
 
 def new_chat():
     st.session_state.current = str(uuid.uuid4())
     st.session_state.draft = {"messages": [], "title": "New Chat"}
     st.session_state.doc_uploaded = False
+    st.session_state.history_shown = HISTORY_PAGE
+    st.rerun()
+
+def finish_upload(pending):
+    try:
+        r = pending["future"].result()
+    except Exception as e:
+        return "error", f"Connection error: {str(e)}"
+    try:
+        res = r.json()
+    except ValueError:
+        return "error", f"Upload failed: {r.text}"
+
+    if r.status_code != 200:
+        return "error", f"Upload failed: {res.get('detail')}"
+
+    sid = pending["sid"]
+    if sid in st.session_state.sessions:
+        st.session_state.sessions[sid]["doc_uploaded"] = True
+        save_index(st.session_state.sessions)
+    elif sid == st.session_state.current and st.session_state.draft:
+        st.session_state.draft["doc_uploaded"] = True
+    if sid == st.session_state.current:
+        st.session_state.doc_uploaded = True
+    # Release the uploaded bytes and request buffers held in cycles
+    gc.collect()
+    return "success", f"Processed successfully ({res['chunks']} chunks)"
+
+@st.fragment(run_every=1)
+def upload_status():
+    pending = st.session_state.get("upload")
+    if not pending:
+        return
+    if not pending["future"].done():
+        st.info("⏳ Processing document...")
+        return
+    del st.session_state.upload
+    st.session_state.upload_result = finish_upload(pending)
     st.rerun()
 
+def show_older():
+    st.session_state.history_shown += HISTORY_PAGE
+
+@st.fragment
+def render_history(messages):
+    # Only the newest messages are drawn; older ones load on demand
+    hidden = len(messages) - st.session_state.history_shown
+    if hidden > 0:
+        st.button(f"⬆️ Load older messages ({hidden} hidden)", on_click=show_older, use_container_width=True)
+    for msg in messages[-st.session_state.history_shown:]:
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
+            if "mode" in msg:
+                st.caption(f"Mode: {msg['mode']}")
+
 # ---------------- STATE ----------------
 if "sessions" not in st.session_state:
     st.session_state.sessions = load_sessions()
@@ -44,6 +176,8 @@ if "draft" not in st.session_state:
     st.session_state.draft = None
 if "doc_uploaded" not in st.session_state:
     st.session_state.doc_uploaded = False
+if "history_shown" not in st.session_state:
+    st.session_state.history_shown = HISTORY_PAGE
 
 session = st.session_state.sessions.get(st.session_state.current) or st.session_state.draft
 
@@ -66,10 +200,10 @@ with st.sidebar:
             st.session_state.current = sid
             st.session_state.draft = None
             st.session_state.doc_uploaded = data.get("doc_uploaded", False)
+            st.session_state.history_shown = HISTORY_PAGE
             st.rerun()
         if c2.button("🗑️", key=f"d_{sid}"):
-            del st.session_state.sessions[sid]
-            save_sessions()
+            delete_session(sid)
             new_chat()
         st.caption(f"{len(data['messages'])} messages")
 
@@ -77,32 +211,25 @@ with st.sidebar:
     st.subheader("📄 Upload Document")
 
     file = st.file_uploader("PDF or DOCX", type=["pdf", "docx"])
-    if file and st.button("Process", use_container_width=True):
+    if file and st.button("Process", use_container_width=True, disabled="upload" in st.session_state):
         if not st.session_state.current:
             st.error("No active session!")
         else:
-            with st.spinner("Processing document..."):
-                try:
-                    r = requests.post(
-                        f"{API_URL}/upload",
-                        params={"session_id": st.session_state.current},
-                        files={"file": (file.name, file, file.type)}
-                    )
-                    try:
-                        res = r.json()
-                    except ValueError:
-                        st.error(f"Upload failed: {r.text}")
-                        res = None
-
-                    if r.status_code == 200 and res:
-                        st.session_state.doc_uploaded = True
-                        session["doc_uploaded"] = True
-                        st.success(f"Processed successfully ({res['chunks']} chunks)")
-                    else:
-                        detail = res.get("detail") if res else r.text
-                        st.error(f"Upload failed: {detail}")
-                except Exception as e:
-                    st.error(f"Connection error: {str(e)}")
+            # Runs on a worker thread; upload_status() polls it without blocking reruns
+            st.session_state.upload = {
+                "sid": st.session_state.current,
+                "future": EXECUTOR.submit(
+                    HTTP.post,
+                    f"{API_URL}/upload",
+                    params={"session_id": st.session_state.current},
+                    files={"file": (file.name, file.getvalue(), file.type)},
+                ),
+            }
+    upload_status()
+
+    if "upload_result" in st.session_state:
+        kind, text = st.session_state.pop("upload_result")
+        (st.success if kind == "success" else st.error)(text)
 
     st.divider()
     mode = st.radio(
@@ -116,11 +243,7 @@ with st.sidebar:
 
 # ---------------- CHAT HISTORY ----------------
 if session and session.get("messages"):
-    for msg in session["messages"]:
-        with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-            if "mode" in msg:
-                st.caption(f"Mode: {msg['mode']}")
+    render_history(session["messages"])
 
 # ---------------- CHAT INPUT ----------------
 if prompt := st.chat_input("Ask a question..."):
@@ -136,29 +259,40 @@ if prompt := st.chat_input("Ask a question..."):
             }
             session = st.session_state.sessions[st.session_state.current]
             st.session_state.draft = None
+            save_index(st.session_state.sessions)
 
-        session["messages"].append({"role": "user", "content": prompt})
+        user_msg = {"role": "user", "content": prompt}
+        session["messages"].append(user_msg)
+        append_messages(st.session_state.current, user_msg)
         with st.chat_message("user"):
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    r = requests.post(
+                    r = HTTP.post(
                         f"{API_URL}/query",
                         json={
                             "question": prompt,
                             "mode": mode,
                             "session_id": st.session_state.current,
+                            "stream": True,
                         },
+                        stream=True,
                     )
-                    answer = r.json().get("answer", "Error")
-                    st.markdown(answer)
+                    if r.ok:
+                        answer = st.write_stream(
+                            sse_tokens(r.iter_content(chunk_size=None, decode_unicode=True))
+                        )
+                    else:
+                        answer = r.json().get("detail", "Error")
+                        st.markdown(answer)
                     st.caption(f"Mode: {mode}")
 
-                    session["messages"].append({"role": "assistant", "content": answer, "mode": mode})
+                    reply = {"role": "assistant", "content": answer, "mode": mode}
+                    session["messages"].append(reply)
                     session["updated"] = now()
-                    save_sessions()
+                    append_messages(st.session_state.current, reply)
                 except Exception as e:
                     st.error(f"Connection error: {str(e)}")
 
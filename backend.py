@@ -1,39 +1,123 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from datetime import datetime
-import os, uuid
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, PrivateAttr
+from typing import Annotated
+import asyncio, hashlib, multiprocessing, os, shutil, time, uuid, weakref
+from collections import OrderedDict, deque
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import docx2txt
+import faiss
+import orjson
+import numpy as np
+import torch
+from pypdf import PdfReader
+from tokenizers import Tokenizer
 
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_groq import ChatGroq
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.retrievers import BaseRetriever
+from langchain.memory import ConversationSummaryBufferMemory
 from dotenv import load_dotenv
 
+from sse_stream import sse
+from text_splitter import split_documents
+
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
 )
 
 # ---------------- SESSION STORE ----------------
-sessions = {}  # session_id → memory, vectorstore, history
+sessions = OrderedDict()  # session_id → memory, index_path, history; LRU order
+INDEX_CACHE = OrderedDict()  # document sha256 → chunk count, LRU order
+INDEX_LOCKS = weakref.WeakValueDictionary()  # document sha256 → lock; one build per file in this process
+RESPONSE_CACHE = OrderedDict()  # sha256 of everything the LLM sees → (expires, answer)
+
+# ---------------- CONFIG ----------------
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+EMBED_BATCH_SIZE = 128 if EMBED_DEVICE == "cuda" else 64  # bigger batches amortize GPU launches
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # "torch", "torch_int8" or "onnx" (int8)
+INT8_MAX_DRIFT = 0.01  # torch_int8 falls back to fp32 if a sample drifts more (1 - cosine)
+INT8_CHECK_TEXTS = (
+    "What is the refund policy for annual subscriptions?",
+    "The quarterly report shows revenue grew by twelve percent.",
+    "Section 4.2 describes the safety requirements for operators.",
+)
+MEMORY_TOKEN_LIMIT = 1024  # document-only memory; older turns fold into a summary
+HISTORY_LIMIT = 50   # turns kept per session for /history
+MAX_SESSIONS = 10000
+SESSION_TTL = 3600   # seconds idle before a session is evicted
+# Hybrid prompt window grows append-only (stable prefix for provider prompt
+# caching) and is cut back to the last PROMPT_WINDOW_KEEP turns at PROMPT_WINDOW_MAX
+PROMPT_WINDOW_MAX = 20
+PROMPT_WINDOW_KEEP = 10
+VECTOR_CODEC = os.getenv("VECTOR_CODEC", "sq8")  # "sq8" (int8 codes) or "fp32"
+HNSW_MIN_CHUNKS = 2000  # below this a flat scan beats graph search
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 32
+IVF_MIN_CHUNKS = 10000  # from here on vectors are product-quantized
+IVF_MAX_LISTS = 256
+IVF_PQ_M = 48           # 384 dims → 48 sub-vectors of 8 bits each
+IVF_PQ_BITS = 8
+IVF_NPROBE = 8          # lists scanned per query
+EMBED_BATCH_WINDOW = 0.01  # seconds a query waits for others to share its embed batch
+RETRIEVAL_K = 3         # chunks retrieved per question
+DOCUMENT_SYSTEM_PROMPT = (
+    "Answer using only the document excerpts. "
+    "If they don't contain the answer, say that you don't know."
+)
+# Opt-in multi-hop path: ConversationalRetrievalChain rewrites follow-ups into
+# standalone questions before retrieval, at the cost of an extra LLM call
+CONDENSE_QUESTIONS = os.getenv("CONDENSE_QUESTIONS", "").lower() in ("1", "true")
+HYBRID_SYSTEM_PROMPT = (
+    "Answer using the document excerpts when they are relevant, "
+    "and your general knowledge otherwise."
+)
+# Greedy decoding, so an identical prompt gets the same answer and
+# RESPONSE_CACHE can safely share it across sessions
+LLM_TEMPERATURE = 0
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = 3600  # seconds
+SIMILAR_THRESHOLD = 0.92   # cosine similarity for reusing an earlier answer
+SIMILAR_CACHE_SIZE = 256   # remembered questions per session and mode
+CHUNK_TOKENS = 254          # embedder's 256-token window minus [CLS]/[SEP]
+CHUNK_OVERLAP_TOKENS = 32
+PARALLEL_SPLIT_PAGES = 32   # pages before splitting moves to the process pool
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB read size when hashing uploads
+INDEX_DIR = "indexes"  # one saved FAISS index per distinct document (by sha256)
+INDEX_CACHE_SIZE = 32
+SESSION_INDEX_FILE = os.path.join(INDEX_DIR, "sessions.json")  # session_id → index path
+HOT_INDEXES = 8        # loaded indexes kept in RAM
+RETRIEVAL_CACHE_SIZE = 128  # cached query → top-k results per session
 
 # ---------------- MODELS ----------------
 class QueryRequest(BaseModel):
     question: str
     session_id: str
     mode: str = "document_only"
+    stream: bool = False
 
 class ChatResponse(BaseModel):
     answer: str
     session_id: str
 
 # ---------------- HELPERS ----------------
+@lru_cache(maxsize=1)
 def get_llm():
     key = os.getenv("GROQ_API_KEY")
     if not key:
@@ -41,110 +125,557 @@ def get_llm():
     return ChatGroq(
         groq_api_key=key,
         model_name="llama-3.1-8b-instant",
-        temperature=0.6,
+        temperature=LLM_TEMPERATURE,
     )
 
+@lru_cache(maxsize=1)
 def get_embeddings():
-    return HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_embeddings import OnnxInt8Embeddings
+        return OnnxInt8Embeddings(EMBED_MODEL, batch_size=EMBED_BATCH_SIZE)
+    # Normalized vectors let inner product stand in for cosine similarity.
+    # On GPU the weights load in fp16, halving memory traffic per batch
+    model_kwargs = {"device": EMBED_DEVICE}
+    if EMBED_DEVICE == "cuda":
+        model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+    emb = HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True},
+    )
+    if EMBEDDING_BACKEND == "torch_int8" and EMBED_DEVICE == "cpu":
+        quantize_embeddings(emb)
+    return emb
+
+def quantize_embeddings(emb):
+    # Dynamic int8 Linear layers (VNNI dot products on x86), kept only if the
+    # sample embeddings stay within INT8_MAX_DRIFT of fp32
+    transformer = emb._client[0]
+    fp32 = transformer.auto_model
+    before = np.asarray(emb.embed_documents(list(INT8_CHECK_TEXTS)))
+    transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+        fp32, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    after = np.asarray(emb.embed_documents(list(INT8_CHECK_TEXTS)))
+    if (before * after).sum(axis=1).min() < 1 - INT8_MAX_DRIFT:
+        transformer.auto_model = fp32
+
+def make_index(vecs):
+    # Exact search is fastest for small documents, mid-size ones use an HNSW
+    # graph and very large ones a trained IVF-PQ index (48 bytes per vector).
+    # With VECTOR_CODEC=sq8 the first two store int8 codes (4x smaller).
+    n, d = vecs.shape
+    sq8 = VECTOR_CODEC == "sq8"
+    if n < HNSW_MIN_CHUNKS:
+        if not sq8:
+            return faiss.IndexFlatIP(d)
+        index = faiss.IndexScalarQuantizer(
+            d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vecs)
+        return index
+    if n < IVF_MIN_CHUNKS:
+        if sq8:
+            index = faiss.IndexHNSWSQ(
+                d, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(vecs)
+        else:
+            index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    nlist = min(IVF_MAX_LISTS, n // 39)  # faiss wants ~39 training points per list
+    quantizer = faiss.IndexFlatIP(d)
+    index = faiss.IndexIVFPQ(
+        quantizer, d, nlist, IVF_PQ_M, IVF_PQ_BITS, faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(vecs)
+    index.nprobe = IVF_NPROBE
+    return index
+
+def build_vectorstore(chunks, emb):
+    vecs = np.asarray(
+        emb.embed_documents([c.page_content for c in chunks]), dtype="float32"
+    )
+    index = make_index(vecs)
+    index.add(vecs)
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    return FAISS(
+        embedding_function=emb,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, chunks))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
+@lru_cache(maxsize=HOT_INDEXES)
+def load_vectorstore(index_path):
+    return FAISS.load_local(
+        index_path,
+        get_embeddings(),
+        allow_dangerous_deserialization=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
     )
 
-def load_docs(path):
-    ext = path.lower()
+def remember_index(digest, n_chunks):
+    INDEX_CACHE[digest] = n_chunks
+    INDEX_CACHE.move_to_end(digest)
+    if len(INDEX_CACHE) > INDEX_CACHE_SIZE:
+        INDEX_CACHE.popitem(last=False)
+
+def index_saved(index_path):
+    # save_local writes index.pkl last, so a half-written index doesn't count
+    return os.path.exists(os.path.join(index_path, "index.pkl"))
+
+def load_session_indexes():
+    if not os.path.exists(SESSION_INDEX_FILE):
+        return {}
+    with open(SESSION_INDEX_FILE, "rb") as f:
+        return orjson.loads(f.read())
+
+def save_session_indexes():
+    # Write-then-rename: a crash mid-write never leaves a truncated map
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp = f"{SESSION_INDEX_FILE}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(SESSION_INDEXES))
+    os.replace(tmp, SESSION_INDEX_FILE)
+
+SESSION_INDEXES = load_session_indexes()  # survives restarts, unlike `sessions`
+
+def drop_index(session_id):
+    path = SESSION_INDEXES.pop(session_id, None)
+    if session_id in sessions:
+        sessions[session_id]["index_path"] = None
+    save_session_indexes()
+    # Indexes are shared by content hash; delete only once no session uses it
+    # and no upload of the same file is in flight
+    if path and path not in SESSION_INDEXES.values() and os.path.basename(path) not in INDEX_LOCKS:
+        shutil.rmtree(path, ignore_errors=True)
+        INDEX_CACHE.pop(os.path.basename(path), None)
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    # Rust fast tokenizer of the embedding model, so chunks never get truncated
+    tokenizer = Tokenizer.from_pretrained(EMBED_MODEL)
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    return tokenizer
+
+@lru_cache(maxsize=1)
+def get_split_pool():
+    # Never fork this process: it runs torch and tokenizer threads, and a
+    # forked child can inherit their locks held. Workers come from a clean
+    # forkserver with only text_splitter imported.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["text_splitter"])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=ctx)
+
+def load_docs(fileobj, filename):
+    # Parse straight from the upload's spooled file instead of a temp copy
+    ext = filename.lower()
     if ext.endswith(".pdf"):
-        return PyPDFLoader(path).load()
+        return [
+            Document(page_content=page.extract_text(), metadata={"source": filename, "page": i})
+            for i, page in enumerate(PdfReader(fileobj).pages)
+        ]
     if ext.endswith(".docx"):
-        return Docx2txtLoader(path).load()
+        return [Document(page_content=docx2txt.process(fileobj), metadata={"source": filename})]
     raise HTTPException(400, "Unsupported file type")
 
+def hash_file(fileobj):
+    sha = hashlib.sha256()
+    while chunk := fileobj.read(UPLOAD_CHUNK_SIZE):
+        sha.update(chunk)
+    fileobj.seek(0)
+    return sha.hexdigest()
+
+# Both providers are lru_cache singletons; Depends wires them into the handlers
+LLMDep = Annotated[ChatGroq, Depends(get_llm)]
+EmbeddingsDep = Annotated[Embeddings, Depends(get_embeddings)]
+
+def evict_sessions():
+    # Free idle sessions and, past MAX_SESSIONS, the least recently used ones.
+    # Their indexes stay on disk and reattach if the session comes back.
+    now = time.monotonic()
+    while sessions:
+        sid, oldest = next(iter(sessions.items()))
+        if len(sessions) < MAX_SESSIONS and now - oldest["last_used"] < SESSION_TTL:
+            break
+        del sessions[sid]
+
 def get_session(session_id: str):
     if session_id not in sessions:
+        evict_sessions()
         sessions[session_id] = {
-            "memory": ConversationBufferMemory(memory_key="chat_history", return_messages=True),
-            "vectorstore": None,
-            "history": []
+            "memory": ConversationSummaryBufferMemory(
+                llm=get_llm(),
+                max_token_limit=MEMORY_TOKEN_LIMIT,
+                memory_key="chat_history",
+                output_key="answer",
+                return_messages=True,
+            ),
+            "index_path": SESSION_INDEXES.get(session_id),
+            "chain": None,
+            "chain_index": None,  # index_path the cached chain was built for
+            "history": deque(maxlen=HISTORY_LIMIT),
+            "turns": deque(maxlen=2 * HISTORY_LIMIT),  # history as prompt messages
+            "retrievals": OrderedDict(),  # (index_path, question) → top-k docs, LRU order
+            "window": 0,  # number of trailing history turns in the hybrid prompt
+            "similar": {},  # scope → question vectors + answers for paraphrase hits
         }
-    return sessions[session_id]
+    sessions.move_to_end(session_id)
+    session = sessions[session_id]
+    session["last_used"] = time.monotonic()
+    return session
+
+# ---------------- STARTUP ----------------
+@app.on_event("startup")
+def warm_models():
+    # Build both singletons up front so the first upload/query doesn't pay for
+    # them; a missing GROQ_API_KEY fails here instead of on the first query
+    get_embeddings()
+    get_llm()
+    get_split_pool()  # here, not lazily inside an upload's worker thread
+
+@app.on_event("startup")
+async def start_embed_batcher():
+    # Created here so the queue belongs to the server's event loop
+    app.state.embed_queue = asyncio.Queue()  # (question, future) awaiting embedding
+    app.state.embed_batcher = asyncio.create_task(embed_batcher(app.state.embed_queue))
 
 # ---------------- UPLOAD DOCUMENT ----------------
+def index_document(fileobj, filename, index_path, emb):
+    # Blocking parse + split + embed; run off the event loop
+    docs = load_docs(fileobj, filename)
+    if not docs:
+        raise HTTPException(400, "Document has no readable text")
+
+    # Long PDFs split page-parallel across processes; short docs inline
+    pool = get_split_pool() if len(docs) >= PARALLEL_SPLIT_PAGES else None
+    chunks = split_documents(
+        docs, chunk_size=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS,
+        executor=pool, tokenizer=get_tokenizer(),
+    )
+    if not chunks:
+        raise HTTPException(400, "Document cannot be split into chunks")
+
+    # Save under a private name and rename into place, so another process
+    # building the same document can't interleave writes with this one
+    tmp = f"{index_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        build_vectorstore(chunks, emb).save_local(tmp)
+        if os.path.exists(index_path) and not index_saved(index_path):
+            # Leftover of an interrupted write or a partial rmtree; replace it
+            shutil.rmtree(index_path, ignore_errors=True)
+        try:
+            os.replace(tmp, index_path)
+        except OSError:
+            # Someone else's copy landed first; it holds the same vectors
+            if not index_saved(index_path):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)  # gone already after a rename
+    return len(chunks)
+
 @app.post("/upload")
-async def upload_document(session_id: str, file: UploadFile = File(...)):
+async def upload_document(session_id: str, emb: EmbeddingsDep, file: UploadFile = File(...)):
     session = get_session(session_id)
 
     ext = file.filename.lower()
     if not (ext.endswith(".pdf") or ext.endswith(".docx")):
         raise HTTPException(400, "Only PDF or DOCX supported")
 
-    temp_path = f"tmp_{uuid.uuid4()}_{file.filename}"
-    try:
-        with open(temp_path, "wb") as f:
-            f.write(await file.read())
+    # FastAPI already spooled the body to a temp file; hash and parse it in place
+    digest = await asyncio.to_thread(hash_file, file.file)
 
-        docs = load_docs(temp_path)
-        if not docs:
-            raise HTTPException(400, "Document has no readable text")
+    # Identical files share one index, so re-uploads skip embedding entirely.
+    # Concurrent uploads of the same file wait here so only one builds it.
+    index_path = os.path.join(INDEX_DIR, digest)
+    lock = INDEX_LOCKS.setdefault(digest, asyncio.Lock())
+    async with lock:
+        if not index_saved(index_path):
+            n_chunks = await asyncio.to_thread(
+                index_document, file.file, file.filename, index_path, emb
+            )
+        elif digest in INDEX_CACHE:
+            n_chunks = INDEX_CACHE[digest]
+        else:
+            # Saved before a restart: count its vectors instead of re-embedding
+            n_chunks = (await asyncio.to_thread(load_vectorstore, index_path)).index.ntotal
+    remember_index(digest, n_chunks)
 
-        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = splitter.split_documents(docs)
-        if not chunks:
-            raise HTTPException(400, "Document cannot be split into chunks")
+    if session["index_path"] != index_path:
+        drop_index(session_id)
+    session["index_path"] = index_path
+    SESSION_INDEXES[session_id] = index_path
+    save_session_indexes()
+    return {"message": "Document uploaded successfully", "chunks": n_chunks}
 
-        session["vectorstore"] = FAISS.from_documents(chunks, get_embeddings())
-        return {"message": "Document uploaded successfully", "chunks": len(chunks)}
+# ---------------- QUERY ----------------
+class IndexRetriever(BaseRetriever):
+    # Looks the index up through the LRU on each call instead of holding it.
+    # One retriever per session chain, so its result cache dies with the upload.
+    index_path: str
+    k: int = RETRIEVAL_K
+    _cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
 
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    def _get_relevant_documents(self, query, *, run_manager):
+        if query in self._cache:
+            self._cache.move_to_end(query)
+            return self._cache[query]
+        docs = load_vectorstore(self.index_path).similarity_search(query, k=self.k)
+        self._cache[query] = docs
+        if len(self._cache) > RETRIEVAL_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return docs
 
-# ---------------- QUERY ----------------
-@app.post("/query", response_model=ChatResponse)
-async def query(req: QueryRequest):
-    session = get_session(req.session_id)
-    question = req.question.strip()
-    if not question:
-        raise HTTPException(400, "Empty question not allowed")
+def search_index(store, qv, k):
+    # qv is already a unit-norm float32 row, so it goes to faiss as-is: one
+    # inner-product scan, no list round trip or re-normalization
+    _, ids = store.index.search(qv, k)
+    return [store.docstore.search(store.index_to_docstore_id[i]) for i in ids[0] if i != -1]
 
-    llm = get_llm()
+def retrieve(session, question, qv):
+    # Same per-session LRU as IndexRetriever keeps for the chain path
+    cache = session["retrievals"]
+    key = (session["index_path"], question)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    docs = search_index(load_vectorstore(session["index_path"]), qv, RETRIEVAL_K)
+    cache[key] = docs
+    if len(cache) > RETRIEVAL_CACHE_SIZE:
+        cache.popitem(last=False)
+    return docs
 
-    if req.mode == "document_only":
-        if not session["vectorstore"]:
-            raise HTTPException(400, "No document uploaded for this session")
-        retriever = session["vectorstore"].as_retriever(search_kwargs={"k": 3})
-        chain = ConversationalRetrievalChain.from_llm(
+def get_chain(session, llm):
+    # Rebuilt only when the session's document changes
+    if session["chain_index"] != session["index_path"]:
+        session["chain"] = ConversationalRetrievalChain.from_llm(
             llm=llm,
-            retriever=retriever,
+            retriever=IndexRetriever(index_path=session["index_path"]),
             memory=session["memory"],
             return_source_documents=False
         )
-        result = chain({"question": question})
-        answer = result["answer"]
+        session["chain_index"] = session["index_path"]
+    return session["chain"]
+
+def chain_answer(session, question, llm):
+    chain = get_chain(session, llm)
+    result = chain({"question": question})
+    return result["answer"]
+
+def chat_messages(session, question, mode, qv):
+    # Oldest content first and the new turn last, so consecutive requests share
+    # a byte-identical prefix the provider can serve from its prompt cache
+    if mode == "document_only":
+        # Summary of older turns plus the recent ones, from the session memory
+        system = DOCUMENT_SYSTEM_PROMPT
+        turns = session["memory"].load_memory_variables({})["chat_history"]
     else:
-        memory_text = "\n".join(
-            [f"Human: {m['question']}\nAI: {m['answer']}" for m in session["history"][-5:]]
-        )
-        prompt = f"{memory_text}\nHuman: {question}" if memory_text else question
-        answer = llm.invoke(prompt).content
+        messages = session["turns"]
+        turns = list(islice(messages, len(messages) - 2 * session["window"], None))
+        if mode != "hybrid" or not session["index_path"]:
+            return [*turns, HumanMessage(content=question)]
+        system = HYBRID_SYSTEM_PROMPT
+    docs = retrieve(session, question, qv)
+    excerpts = "\n\n".join(d.page_content for d in docs)
+    return [
+        SystemMessage(content=system),
+        *turns,
+        HumanMessage(content=f"Document excerpts:\n\n{excerpts}"),
+        HumanMessage(content=question),
+    ]
 
-    # Save history
+def save_turn(session, question, answer, mode):
     session["history"].append({
         "question": question,
         "answer": answer,
-        "time": datetime.utcnow().isoformat(),
-        "mode": req.mode
+        "time": time.time_ns(),  # epoch ns; no datetime object or string per turn
+        "mode": mode
     })
+    session["turns"] += (HumanMessage(content=question), AIMessage(content=answer))
+    session["window"] += 1
+    if session["window"] >= PROMPT_WINDOW_MAX:
+        session["window"] = PROMPT_WINDOW_KEEP
+
+def response_key(session, question, mode, messages):
+    # Covers every input of the answer: the full prompt, or document + memory
+    # when the chain builds the prompt itself
+    if messages is None:
+        memory = session["memory"]
+        messages = memory.chat_memory.messages
+        parts = [session["index_path"], memory.moving_summary_buffer, question]
+    else:
+        parts = []
+    # Fed piecewise so no prompt-sized string is assembled just to be hashed
+    h = hashlib.sha256(mode.encode())
+    for m in messages:
+        h.update(b"\x00" + m.type.encode() + b": " + m.content.encode())
+    for part in parts:
+        h.update(b"\x00" + part.encode())
+    return h.hexdigest()
+
+def cached_answer(key):
+    hit = RESPONSE_CACHE.get(key)
+    if hit and hit[0] > time.monotonic():
+        RESPONSE_CACHE.move_to_end(key)
+        return hit[1]
+    return None
+
+def remember_answer(key, answer):
+    RESPONSE_CACHE[key] = (time.monotonic() + RESPONSE_CACHE_TTL, answer)
+    RESPONSE_CACHE.move_to_end(key)
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+def similar_scope(session, mode):
+    # Answers that drew on the document are only reusable against the same document
+    return mode if mode == "Normal" else (mode, session["index_path"])
+
+def no_prior_turns(session, mode):
+    # A paraphrase only means the same thing without earlier turns: "why?" or
+    # "tell me more" after different answers must not share one reply
+    if mode == "document_only":
+        memory = session["memory"]
+        return not memory.chat_memory.messages and not memory.moving_summary_buffer
+    return session["window"] == 0
+
+def similar_answer(session, mode, qv):
+    if not no_prior_turns(session, mode):
+        return None
+    cache = session["similar"].get(similar_scope(session, mode))
+    if not cache or not cache["answers"]:
+        return None
+    scores, ids = cache["index"].search(qv, 1)
+    if scores[0, 0] >= SIMILAR_THRESHOLD:
+        return cache["answers"][ids[0, 0]]
+    return None
+
+def remember_similar(session, mode, qv, answer):
+    if not no_prior_turns(session, mode):
+        return
+    cache = session["similar"].setdefault(
+        similar_scope(session, mode), {"index": faiss.IndexFlatIP(qv.shape[1]), "answers": []}
+    )
+    if len(cache["answers"]) >= SIMILAR_CACHE_SIZE:
+        cache["index"].remove_ids(np.arange(1, dtype="int64"))
+        cache["answers"].pop(0)
+    cache["index"].add(qv)
+    cache["answers"].append(answer)
+
+async def record_turn(session, question, mode, answer, memory_saved=False):
+    if mode == "document_only" and not memory_saved:
+        # May summarize older turns with an LLM call, so only this goes to a
+        # thread; every cache and history update stays on the event loop
+        await asyncio.to_thread(
+            session["memory"].save_context, {"question": question}, {"answer": answer}
+        )
+    save_turn(session, question, answer, mode)
+
+async def finish_turn(session, question, mode, answer, key, qv, chain=False):
+    remember_answer(key, answer)
+    remember_similar(session, mode, qv, answer)
+    await record_turn(session, question, mode, answer, memory_saved=chain)
+
+async def embed_batcher(queue):
+    # Concurrent queries arriving within EMBED_BATCH_WINDOW share one
+    # embed_documents call instead of one forward pass each
+    emb = get_embeddings()
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(EMBED_BATCH_WINDOW)
+        while len(batch) < EMBED_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            texts = [q for q, _ in batch]
+            vecs = np.asarray(await asyncio.to_thread(emb.embed_documents, texts), dtype="float32")
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        for (_, fut), v in zip(batch, vecs):
+            if not fut.done():  # done means the caller went away
+                fut.set_result(v[None, :])
+
+async def embed_question(question):
+    # One unit-norm float32 row, shaped for faiss
+    fut = asyncio.get_running_loop().create_future()
+    app.state.embed_queue.put_nowait((question, fut))
+    return await fut
+
+async def stream_answer(session, question, mode, llm, messages, key, qv):
+    if messages is None:
+        answer = await asyncio.to_thread(chain_answer, session, question, llm)
+        yield sse(answer)
+    else:
+        parts = []
+        async for chunk in llm.astream(messages):
+            parts.append(chunk.content)
+            yield sse(chunk.content)
+        answer = "".join(parts)
+    await finish_turn(session, question, mode, answer, key, qv, messages is None)
 
+@app.post("/query", response_model=ChatResponse)
+async def query(req: QueryRequest, llm: LLMDep):
+    session = get_session(req.session_id)
+    question = req.question.strip()
+    if not question:
+        raise HTTPException(400, "Empty question not allowed")
+
+    if req.mode == "document_only" and not session["index_path"]:
+        raise HTTPException(400, "No document uploaded for this session")
+
+    # Exact match first, then a paraphrase of an earlier question in this session
+    qv = await embed_question(question)
+    messages = None
+    if not (CONDENSE_QUESTIONS and req.mode == "document_only"):
+        messages = await asyncio.to_thread(chat_messages, session, question, req.mode, qv)
+    key = response_key(session, question, req.mode, messages)
+    cached = cached_answer(key)
+    if cached is None:
+        cached = similar_answer(session, req.mode, qv)
+    if cached is not None:
+        await record_turn(session, question, req.mode, cached)
+        if req.stream:
+            return StreamingResponse(iter([sse(cached)]), media_type="text/event-stream")
+        return ChatResponse(answer=cached, session_id=req.session_id)
+
+    if req.stream:
+        # Server-sent token events; history is saved once the stream completes
+        return StreamingResponse(
+            stream_answer(session, question, req.mode, llm, messages, key, qv),
+            media_type="text/event-stream",
+        )
+
+    if messages is None:
+        # The chain (condense, retrieval, memory, LLM calls) is sync; keep it off the loop
+        answer = await asyncio.to_thread(chain_answer, session, question, llm)
+    else:
+        answer = (await llm.ainvoke(messages)).content
+
+    await finish_turn(session, question, req.mode, answer, key, qv, messages is None)
     return ChatResponse(answer=answer, session_id=req.session_id)
 
 # ---------------- HISTORY ----------------
+# Async so they run on the event loop with the other handlers, never in the
+# threadpool alongside them, when touching `sessions` and SESSION_INDEXES
 @app.get("/history/{session_id}")
-def history(session_id: str):
+async def history(session_id: str):
     session = get_session(session_id)
     return session["history"]
 
 # ---------------- DELETE SESSION ----------------
 @app.delete("/session/{session_id}")
-def delete_session(session_id: str):
+async def delete_session(session_id: str):
     sessions.pop(session_id, None)
+    drop_index(session_id)
     return {"message": "Session deleted"}
 
 # ---------------- ROOT ----------------
@@ -155,4 +686,15 @@ def root():
 # ---------------- RUN ----------------
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("backend:app", host="0.0.0.0", port=8000, reload=True)
+    debug = os.getenv("DEBUG", "").lower() in ("1", "true")
+    # Always one worker process: sessions, memory, caches and the session
+    # index map are process state (see README)
+    uvicorn.run(
+        "backend:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=debug,
+        workers=1,
+        loop="uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,21 @@
+# gunicorn -c gunicorn.conf.py backend:app
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn.workers.UvicornWorker"
+# Exactly one worker; the README explains why the backend is single-process
+workers = 1
+
+# Import the app in the master so a restarted worker forks with it loaded
+preload_app = True
+
+def on_starting(server):
+    # -w/--workers on the command line overrides the value above
+    if server.cfg.workers != 1:
+        raise RuntimeError("backend keeps sessions in process memory; run exactly one worker")
+
+def when_ready(server):
+    # Build the embedder before forking so a worker restart doesn't reload
+    # ~90MB of weights. CUDA contexts can't survive fork, so a GPU worker
+    # loads its own copy at startup.
+    import backend
+    if backend.EMBED_DEVICE == "cpu":
+        backend.get_embeddings()
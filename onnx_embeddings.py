@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# ---------------- INT8 ONNX EMBEDDINGS ----------------
+class OnnxInt8Embeddings(Embeddings):
+    """MiniLM exported to ONNX and dynamically quantized to int8.
+
+    The export + quantization runs once and is cached in ``cache_dir``;
+    later starts load the quantized graph straight from disk.
+    """
+
+    QUANTIZED_FILE = "model_quantized.onnx"
+
+    def __init__(self, model_name, cache_dir="onnx_model", batch_size=64):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(os.path.join(cache_dir, self.QUANTIZED_FILE)):
+            self._export(model_name, cache_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            cache_dir,
+            file_name=self.QUANTIZED_FILE,
+            provider="CPUExecutionProvider",
+        )
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _export(model_name, cache_dir):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(cache_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(cache_dir)
+
+        quantizer = ORTQuantizer.from_pretrained(cache_dir)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=cache_dir, quantization_config=qconfig)
+
+    def _encode(self, texts):
+        inputs = self.tokenizer(
+            texts, padding=True, truncation=True, return_tensors="np"
+        )
+        hidden = np.asarray(self.model(**inputs).last_hidden_state)
+
+        # Mean pooling over real tokens, then L2-normalize (same as sentence-transformers)
+        mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype("float32")
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # Batch similar lengths together so little compute goes to padding,
+        # then put the vectors back in input order
+        order = np.argsort([len(t) for t in texts])
+        vecs = np.empty((len(texts), self.model.config.hidden_size), dtype="float32")
+        for i in range(0, len(texts), self.batch_size):
+            idx = order[i:i + self.batch_size]
+            vecs[idx] = self._encode([texts[j] for j in idx])
+        return vecs.tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
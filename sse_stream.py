@@ -0,0 +1,21 @@
+# Server-sent event framing shared by backend.py (writer) and app.py (reader).
+# Kept free of FastAPI/Streamlit imports so both sides, and tests, can load it.
+
+# ---------------- SSE ----------------
+def sse(text):
+    # One server-sent event; newlines inside a token become extra data lines
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+def sse_tokens(chunks):
+    # Yield the text of each event as soon as it is complete. Lines are split
+    # on "\n" only, exactly as sse() writes them: str.splitlines() (and so
+    # requests' iter_lines) would also break on \r, \u2028 etc. inside a token.
+    buf, data = "", []
+    for chunk in chunks:
+        *lines, buf = (buf + chunk).split("\n")
+        for line in lines:
+            if line.startswith("data: "):
+                data.append(line[6:])
+            elif not line and data:
+                yield "\n".join(data)
+                data = []
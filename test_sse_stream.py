@@ -0,0 +1,31 @@
+import pytest
+
+from sse_stream import sse, sse_tokens
+
+TOKENS = ["Hel", "lo", "", "a\u2028b", " world\n", "a\r", "\r\nb", "x y", "\x0b\x0c\x1c\x1d\x1e", "\n\n", "é✓"]
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10**6])
+def test_round_trip_any_chunking(size):
+    stream = "".join(sse(t) for t in TOKENS)
+    assert list(sse_tokens(chunked(stream, size))) == TOKENS
+
+
+def test_event_framing():
+    assert sse("a\nb") == "data: a\ndata: b\n\n"
+    assert sse("") == "data: \n\n"
+
+
+def test_incomplete_event_is_not_yielded():
+    assert list(sse_tokens(["data: partial\n"])) == []
+    assert list(sse_tokens(["data: done\n\n", "data: cut"])) == ["done"]
+
+
+def test_each_event_yields_as_soon_as_complete():
+    events = sse_tokens(iter(["data: one\n\n", "data: two\n\n"]))
+    assert next(events) == "one"
+    assert next(events) == "two"
@@ -0,0 +1,129 @@
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from langchain_core.documents import Document
+
+from text_splitter import split_documents, split_text
+
+
+def random_text(rng, paragraphs=6):
+    # Unique words, so coverage can be checked word by word
+    counter = iter(range(10**6))
+    paras = []
+    for _ in range(paragraphs):
+        lines = []
+        for _ in range(rng.randint(1, 4)):
+            lines.append(" ".join(f"w{next(counter)}" for _ in range(rng.randint(1, 120))))
+        paras.append("\n".join(lines))
+    return "\n\n".join(paras)
+
+
+def assert_covers(text, chunks):
+    seen = {w for c in chunks for w in c.split()}
+    assert set(text.split()) <= seen
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_character_chunks_cover_text_within_size(seed):
+    rng = random.Random(seed)
+    text = random_text(rng)
+    chunks = split_text(text, chunk_size=300, chunk_overlap=60)
+    assert chunks
+    assert all(len(c) <= 300 for c in chunks)
+    assert_covers(text, chunks)
+
+
+def test_prefers_paragraph_breaks():
+    text = "alpha beta\n\ngamma delta epsilon"
+    assert split_text(text, chunk_size=20, chunk_overlap=2) == ["alpha beta", "gamma delta epsilon"]
+
+
+def test_short_and_empty_text():
+    assert split_text("one chunk", chunk_size=100, chunk_overlap=10) == ["one chunk"]
+    assert split_text("", chunk_size=100, chunk_overlap=10) == []
+    assert split_text(" \n\n ", chunk_size=100, chunk_overlap=10) == []
+
+
+def test_word_longer_than_chunk_terminates():
+    text = "x" * 250 + " tail"
+    chunks = split_text(text, chunk_size=100, chunk_overlap=20)
+    assert all(len(c) <= 100 for c in chunks)
+    assert chunks[-1].endswith("tail")
+
+
+def test_split_documents_keeps_metadata_per_chunk():
+    docs = [
+        Document(page_content=random_text(random.Random(i)), metadata={"page": i})
+        for i in range(4)
+    ]
+    chunks = split_documents(docs, chunk_size=300, chunk_overlap=60)
+    with ProcessPoolExecutor(2) as pool:
+        pooled = split_documents(docs, chunk_size=300, chunk_overlap=60, executor=pool)
+    assert [c.page_content for c in pooled] == [c.page_content for c in chunks]
+    assert {c.metadata["page"] for c in chunks} == {0, 1, 2, 3}
+    chunks[0].metadata["page"] = -1
+    assert docs[0].metadata["page"] == 0
+
+
+def word_tokenizer():
+    # Offline stand-in for the embedder's fast tokenizer: words and
+    # punctuation are separate tokens, so tokens outnumber words
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    tokenizer = Tokenizer(models.WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return tokenizer
+
+
+def token_ends(tokenizer, text):
+    import numpy as np
+
+    enc = tokenizer.encode(text, add_special_tokens=False)
+    return np.array([e for _, e in enc.offsets], dtype=np.int64)
+
+
+def n_tokens(tokenizer, text):
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def test_token_chunks_advance_past_long_paragraph():
+    tokenizer = word_tokenizer()
+    short = " ".join(f"a{i}" for i in range(100))
+    long = " ".join(f"b{i}" for i in range(400))
+    text = f"{short}\n\n{long}"
+    chunks = split_text(text, token_ends(tokenizer, text), chunk_size=254, chunk_overlap=32)
+    assert len(chunks) < 10
+    assert all(n_tokens(tokenizer, c) <= 254 for c in chunks)
+    assert_covers(text, chunks)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_token_chunks_cover_text_within_size(seed):
+    tokenizer = word_tokenizer()
+    rng = random.Random(seed)
+    text = random_text(rng).replace("w1", "w.1")  # some words span two tokens
+    chunks = split_text(text, token_ends(tokenizer, text), chunk_size=64, chunk_overlap=8)
+    assert len(chunks) <= n_tokens(tokenizer, text)
+    assert all(n_tokens(tokenizer, c) <= 64 for c in chunks)
+    assert_covers(text, chunks)
+
+
+def test_split_documents_with_tokenizer_and_pool():
+    tokenizer = word_tokenizer()
+    docs = [
+        Document(page_content=random_text(random.Random(i)), metadata={"page": i})
+        for i in range(4)
+    ]
+    chunks = split_documents(docs, chunk_size=64, chunk_overlap=8, tokenizer=tokenizer)
+    # Same start method as backend.get_split_pool
+    ctx = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(2, mp_context=ctx) as pool:
+        pooled = split_documents(
+            docs, chunk_size=64, chunk_overlap=8, executor=pool, tokenizer=tokenizer
+        )
+    assert [c.page_content for c in pooled] == [c.page_content for c in chunks]
+    assert all(n_tokens(tokenizer, c.page_content) <= 64 for c in chunks)
+    for doc in docs:
+        assert_covers(doc.page_content, [c.page_content for c in chunks])
@@ -0,0 +1,76 @@
+import re
+from functools import partial
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Kept free of torch/FastAPI imports so process-pool workers, which start from
+# a forkserver (or spawn) rather than a fork of the backend, import it cheaply.
+
+# ---------------- SPLITTER ----------------
+# Same preference order as RecursiveCharacterTextSplitter: paragraph, line, word
+SEPARATORS = re.compile(r"\n\n|\n| ")
+SEPARATOR_LEVELS = {"\n\n": 0, "\n": 1, " ": 2}
+
+def break_tiers(text):
+    # One scan for every separator; tier i holds offsets of breaks of level <= i
+    matches = [(m.end(), SEPARATOR_LEVELS[m.group()]) for m in SEPARATORS.finditer(text)]
+    if not matches:
+        return [np.empty(0, dtype=np.int64)] * 3
+    pos, lvl = np.array(matches, dtype=np.int64).T
+    return [pos[lvl <= i] for i in range(3)]
+
+def split_text(text, token_ends=None, chunk_size=1000, chunk_overlap=200):
+    # Sizes are in characters, or in tokens when token_ends (the end offset of
+    # every token in text) is given. Second so executor.map can pass it.
+    n = len(text)
+    if token_ends is None:
+        def shift(c, k):
+            return max(0, min(c + k, n))
+    else:
+        def shift(c, k):
+            # Offset k tokens after (or before, k < 0) offset c
+            u = int(np.searchsorted(token_ends, c, side="right")) + k
+            return 0 if u <= 0 else n if u > len(token_ends) else int(token_ends[u - 1])
+
+    tiers = break_tiers(text)
+    words = tiers[2]
+    chunks = []
+    start = prev_end = 0
+    while start < n:
+        end = shift(start, chunk_size)
+        if end < n:
+            # Latest break of the best level that still leaves room for the
+            # overlap and lies past the previous chunk, so the loop always advances
+            floor = max(shift(start, chunk_overlap), prev_end)
+            for breaks in tiers:
+                i = np.searchsorted(breaks, end, side="right") - 1
+                if i >= 0 and breaks[i] > floor:
+                    end = int(breaks[i])
+                    break
+        piece = text[start:end].strip()
+        if piece:
+            chunks.append(piece)
+        if end >= n:
+            break
+        prev_end = end
+        # Next chunk starts at the first word boundary inside the overlap window
+        j = np.searchsorted(words, shift(end, -chunk_overlap), side="left")
+        start = int(words[j]) if j < len(words) and words[j] < end else end
+    return chunks
+
+def split_documents(docs, chunk_size=1000, chunk_overlap=200, executor=None, tokenizer=None):
+    split = partial(split_text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    texts = [d.page_content for d in docs]
+    args = (texts,)
+    if tokenizer is not None:
+        # Count in the embedder's own tokens: one batched pass of the Rust
+        # tokenizer, so workers only receive the offsets
+        encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+        args += ([np.array([e for _, e in enc.offsets], dtype=np.int64) for enc in encodings],)
+    pieces = executor.map(split, *args, chunksize=8) if executor else map(split, *args)
+    return [
+        Document(page_content=chunk, metadata=dict(doc.metadata))
+        for doc, chunks in zip(docs, pieces)
+        for chunk in chunks
+    ]